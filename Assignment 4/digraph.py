@@ -1,7 +1,8 @@
+from array import array
 import copy
+from collections import deque
 from enum import Enum
 from graphviz import Digraph
-import random
 from warnings import warn
 
 class DAG(Digraph):
@@ -13,6 +14,15 @@ class DAG(Digraph):
 
 		# internal vars with a bit more functionality. Need to bookkeep this properly
 		self._nodes: dict[str, Node] = {}
+		self._node_list: list[Node] = []
+		# the adjacency itself, in CSR form (ptr, ids): the children (parents) of node id i are
+		# ids[ptr[i]:ptr[i + 1]] of _children (_parents), in the order the edges were added.
+		# Node objects only hold their id and read their relatives from here
+		self._children = (array('l', [0]), array('l'))
+		self._parents = (array('l', [0]), array('l'))
+		# transitive closures, rebuilt after changes (see _closures)
+		self._version = 0
+		self._closure_cache = None
 
 		# routines
 		self.add_nodes(nodes)
@@ -21,60 +31,104 @@ class DAG(Digraph):
 	def add_nodes(self, nodes):
 		for node in nodes:
 			self.node(node, node)  # , color="red")
-			self._nodes[node] = Node(node)
+			if node not in self._nodes:
+				self._nodes[node] = Node(node, self, len(self._node_list))
+				self._node_list.append(self._nodes[node])
+				# no relatives yet
+				for ptr, _ in (self._children, self._parents):
+					ptr.append(ptr[-1])
+		self._invalidate()
 
 	def add_edges(self, edges):
+		"""
+		Adds the edges head -> tail. Every call rebuilds the adjacency arrays, in O(V + E), so
+		edges are best added in batches.
+		"""
+		heads, tails = array('l'), array('l')
 		for head, tail in edges:
 			if head in self.nodes and tail in self.nodes:
 				self.edge(head, tail)
-				self._nodes[head].add_child(tail)
-				self._nodes[tail].add_parent(head)
+				heads.append(self._nodes[head].id)
+				tails.append(self._nodes[tail].id)
 			else:
 				warn(f"Node {head} or {tail} not in node list, edge not added")
 
-	def recalculate_edges(self):
-		for head, tail in self.edges:
-			if head in self.nodes and tail in self.nodes:
-				self.edge(head, tail)
-				self._nodes[head].add_child(tail)
-				self._nodes[tail].add_parent(head)
-			else:
-				warn(f"Node {head} or {tail} not in node list, edge not added")
-
-	def set_conditionals(self, nodes: list['Node']):
-		self.conditional_set = set(nodes)
-
-	def find_all_paths(
-			self,
-			start: 'Node'|str,
-			end: 'Node'|str,
-			current_path=None,
-			all_paths=None
-	):
+		self._children = _csr_extend(self._children, heads, tails)
+		self._parents = _csr_extend(self._parents, tails, heads)
+		self._invalidate()
 
-		if all_paths is None:
-			all_paths = []
+	def recalculate_edges(self):
+		self.add_edges(self.edges)
 
-		if current_path is None:
-			current_path = []
+	def _invalidate(self):
+		self._version += 1
 
-		start = self.node_by_name(start)
-		end = self.node_by_name(end)
+	def _id(self, node):
+		return self._nodes[str(node)].id
 
-		current_path = current_path + [start]
+	def set_conditionals(self, nodes: list['Node']):
+		self.conditional_set = set(nodes)
 
+	def iter_paths(self, start: 'Node | str', end: 'Node | str', max_length=None, limit=None):
+		"""
+		Generates the simple undirected paths from start to end one at a time, depth first
+		with children before parents, keeping a single stack. max_length bounds the number of
+		edges of a path and limit the number of paths generated.
+		"""
+		for name, bound in (('max_length', max_length), ('limit', limit)):
+			if bound is not None and bound < 0:
+				raise ValueError(f"{name} must be non-negative, got {bound}")
+
+		(child_ptr, child_ids), (parent_ptr, parent_ids) = self._children, self._parents
+		nodes = self._node_list
+		start, end = self._id(start), self._id(end)
+
+		if limit == 0:
+			return
 		if start == end:
-			all_paths.append(Path(current_path, self))
-			return all_paths
+			yield Path([nodes[start]], self, [])
+			return
+
+		# node ids on the path, the next neighbour to try for each, and the edges in between
+		# ("0": forward, "1": backward, as in link_type)
+		path, cursor, edges = [start], [0], []
+		on_path = bytearray(len(nodes))
+		on_path[start] = 1
+		found = 0
+		while path:
+			i = path[-1]
+			n_children = child_ptr[i + 1] - child_ptr[i]
+			n_relatives = n_children + parent_ptr[i + 1] - parent_ptr[i]
+			k = cursor[-1]
+			if k == n_relatives or (max_length is not None and len(edges) >= max_length):
+				on_path[path.pop()] = 0
+				cursor.pop()
+				if edges:
+					edges.pop()
+				continue
+
+			cursor[-1] += 1
+			if k < n_children:
+				j, edge = child_ids[child_ptr[i] + k], "0"
+			else:
+				j, edge = parent_ids[parent_ptr[i] + k - n_children], "1"
 
-		for relative in start.get_relatives():
-			if isinstance(relative, str):
-				relative = self._nodes.get(relative)
+			if on_path[j]:
+				continue
+			if j == end:
+				yield Path([nodes[n] for n in path + [j]], self, edges + [edge])
+				found += 1
+				if found == limit:
+					return
+				continue
 
-			if relative not in current_path:
-				self.find_all_paths(relative, end, current_path, all_paths)
+			path.append(j)
+			cursor.append(0)
+			edges.append(edge)
+			on_path[j] = 1
 
-		return all_paths
+	def find_all_paths(self, start: 'Node | str', end: 'Node | str', max_length=None, limit=None):
+		return list(self.iter_paths(start, end, max_length, limit))
 
 	def node_by_name(self, name):
 		if isinstance(name, str):
@@ -82,29 +136,34 @@ class DAG(Digraph):
 		else:
 			return name
 
+	def _is_child(self, child, parent):
+		# child and parent are ids
+		ptr, ids = self._children
+		return child in ids[ptr[parent]:ptr[parent + 1]]
+
 	def link_type(self, n1, n2):
-		if not {n1}.issubset(n2.get_relatives()):
-			raise ValueError(f"Nodes {n1}, {n2} are not neighbours")
-		if n1 in n2.children:
+		i1, i2 = self._id(n1), self._id(n2)
+		if self._is_child(i1, i2):
 			return "1"
-		else:
+		elif self._is_child(i2, i1):
 			return "0"
+		else:
+			raise ValueError(f"Nodes {n1}, {n2} are not neighbours")
 
 	def node_type(self, n1, n2, n3):
-		n1, n2, n3 = self.node_by_name(n1), self.node_by_name(n2), self.node_by_name(n3)
-		# assert that these are existing nodes
+		i1, i2, i3 = self._id(n1), self._id(n2), self._id(n3)
 		# assert that these are actually neighbours
-		if not {n1, n3}.issubset(n2.get_relatives()):
+		if not all(self._is_child(i, i2) or self._is_child(i2, i) for i in (i1, i3)):
 			raise ValueError(f"Nodes {n1}, {n2}, {n3} are not neighbours")
 
 		# get connection between nodes. 0 is right, 1 is left
 		# 01: collider; 10: fork; 11, 00: mediator
-		if n1 in n2.children:
+		if self._is_child(i1, i2):
 			link = "1"
 		else:
 			link = "0"
 
-		if n3 in n2.children:
+		if self._is_child(i3, i2):
 			link += "0"
 		else:
 			link += "1"
@@ -116,88 +175,303 @@ class DAG(Digraph):
 		else:
 			return Link.MEDIATOR
 
-	def get_descendants(self, node):
-		descendants = []
-		node = self.node_by_name(node)
+	def _closures(self):
+		"""
+		(descendants, ancestors): for every node id a bitset (Python int) with bit j set if
+		node j is a descendant, resp. ancestor. Computed once per graph version in topological
+		order, so shared sub-DAGs are only visited once.
+		"""
+		if self._closure_cache is None or self._closure_cache[0] != self._version:
+			(child_ptr, child_ids), (parent_ptr, parent_ids) = self._children, self._parents
+			n = len(self._node_list)
+
+			# Kahn's algorithm
+			in_degree = [parent_ptr[i + 1] - parent_ptr[i] for i in range(n)]
+			order = [i for i in range(n) if in_degree[i] == 0]
+			for i in order:
+				for k in range(child_ptr[i], child_ptr[i + 1]):
+					in_degree[child_ids[k]] -= 1
+					if in_degree[child_ids[k]] == 0:
+						order.append(child_ids[k])
+			if len(order) < n:
+				raise ValueError("Graph contains a cycle")
+
+			descendants = [0] * n
+			for i in reversed(order):
+				for k in range(child_ptr[i], child_ptr[i + 1]):
+					descendants[i] |= 1 << child_ids[k] | descendants[child_ids[k]]
+
+			ancestors = [0] * n
+			for i in order:
+				for k in range(parent_ptr[i], parent_ptr[i + 1]):
+					ancestors[i] |= 1 << parent_ids[k] | ancestors[parent_ids[k]]
+
+			self._closure_cache = (self._version, descendants, ancestors)
+
+		return self._closure_cache[1:]
+
+	def _closure(self, ids, relation):
+		# mask of the ids reachable from ids by repeatedly following relation (a CSR pair),
+		# ids included. Linear in the part of the graph visited, unlike _closures
+		ptr, relatives = relation
+		seen = bytearray(len(ptr) - 1)
+		stack = list(ids)
+		for i in stack:
+			seen[i] = 1
+		while stack:
+			i = stack.pop()
+			for k in range(ptr[i], ptr[i + 1]):
+				j = relatives[k]
+				if not seen[j]:
+					seen[j] = 1
+					stack.append(j)
+
+		return seen
+
+	def _names_of(self, bits):
+		nodes = self._node_list
+		found = set()
+		while bits:
+			low = bits & -bits
+			found.add(nodes[low.bit_length() - 1].name)
+			bits ^= low
+
+		return found
 
-		if not node.children:
-			return []
+	def get_descendants(self, node):
+		descendants, _ = self._closures()
+		return self._names_of(descendants[self._id(node)])
 
-		for child in node.children:
-			descendants.append(child)
-			descendants.extend(self.get_descendants(child))
+	def get_ancestors(self, nodes):
+		# names of the given nodes and all their ancestors
+		_, ancestors = self._closures()
+		bits = 0
+		for node in nodes:
+			i = self._id(node)
+			bits |= 1 << i | ancestors[i]
 
-		return set(descendants)
+		return self._names_of(bits)
 
-	def conditional_paths(self, node1, node2, condition=None):
+	def _condition_set(self, condition):
 		if condition is None:
-			condition = set(self.conditional_set)
+			return set(self.conditional_set)
+		elif isinstance(condition, str):
+			return set([condition])
 		else:
-			if isinstance(condition, str):
-				condition = set([condition])
+			return set(condition)
+
+	def _condition_ids(self, condition):
+		# ids of the conditioning nodes; names not in the graph cannot block or open a path
+		return [self._nodes[str(n)].id for n in self._condition_set(condition) if str(n) in self._nodes]
+
+	def _observed_masks(self, condition):
+		# masks of the conditioning set and of it together with all its ancestors. The
+		# ancestors are walked here rather than taken from _closures, which costs O(V^2) to build
+		ids = self._condition_ids(condition)
+		observed = bytearray(len(self._node_list))
+		for i in ids:
+			observed[i] = 1
+
+		return observed, self._closure(ids, self._parents)
+
+	def _reachable_mask(self, start, observed, observed_ancestors):
+		(child_ptr, child_ids), (parent_ptr, parent_ids) = self._children, self._parents
+		n = len(self._node_list)
+
+		# state 2 * i + 1 means node i was entered from a child (moving up), 2 * i from a parent.
+		# The start node is left in both directions whether it is observed or not.
+		visited = bytearray(2 * n)
+		visited[2 * start + 1] = 1
+		queue = deque([2 * start + 1])
+		reached = bytearray(n)
+		while queue:
+			state = queue.popleft()
+			i, up = state >> 1, state & 1
+			if state == 2 * start + 1:
+				# only queued once, as the start
+				go_up = go_down = True
 			else:
-				condition = set(condition)
+				reached[i] = 1
+				unobserved = not observed[i]
+				# entered from a child: mediator or fork, open when unobserved
+				# entered from a parent: mediator if we continue down, collider if we turn back up
+				go_up = unobserved if up else bool(observed_ancestors[i])
+				go_down = unobserved
+
+			if go_up:
+				for k in range(parent_ptr[i], parent_ptr[i + 1]):
+					state = 2 * parent_ids[k] + 1
+					if not visited[state]:
+						visited[state] = 1
+						queue.append(state)
+			if go_down:
+				for k in range(child_ptr[i], child_ptr[i + 1]):
+					state = 2 * child_ids[k]
+					if not visited[state]:
+						visited[state] = 1
+						queue.append(state)
+
+		reached[start] = 0
+		return reached
+
+	def reachable(self, node, condition=None):
+		"""
+		Names of all nodes connected to node by a path that is open given condition
+		("reachable" procedure of Koller & Friedman, Alg. 3.1), in O(V + E).
+		A path is open if every fork or mediator on it is unobserved and every collider is
+		observed or has an observed descendant. Only nodes inside the path are checked,
+		as in conditional_paths.
+		"""
+		reached = self._reachable_mask(self._id(node), *self._observed_masks(condition))
+		return set(n.name for n in self._node_list if reached[n.id])
+
+	def independence_matrix(self, sources, targets, condition=None):
+		"""
+		Nested lists with entry [i][j] True if sources[i] and targets[j] are independent given
+		condition, as decided by conditionally_independent. Needs one reachability pass per
+		source, shared by all targets.
+		"""
+		observed, observed_ancestors = self._observed_masks(condition)
+		target_ids = [self._id(target) for target in targets]
+
+		matrix = []
+		for source in sources:
+			i = self._id(source)
+			reached = self._reachable_mask(i, observed, observed_ancestors)
+			matrix.append([j != i and not reached[j] for j in target_ids])
+
+		return matrix
+
+	def conditional_paths(self, node1, node2, condition=None, stop_at_open=False):
+		"""
+		Splits the paths between node1 and node2 into open and blocked ones. With
+		stop_at_open, path generation ends at the first open path.
+		"""
+		condition = self._condition_set(condition)
+		descendants, _ = self._closures()
+		observed = 0
+		for i in self._condition_ids(condition):
+			observed |= 1 << i
 
-		paths = self.find_all_paths(node1, node2)
 		open_paths = []
 		blocked_paths = []
 
-		for path in paths:
+		for path in self.iter_paths(node1, node2):
 			blocked = False
 			for i, node in enumerate(path.path[1:-1]):
 				j = i + 1 # legibility
-				link_type = self.node_type(path.path[j - 1], node, path.path[j + 1])
+				# edges into and out of the node, see node_type
+				link_type = path.edges[j - 1] + path.edges[j]
 
-				if link_type == Link.MEDIATOR or link_type == Link.FORK:
+				if link_type != "01":
+					# mediator or fork
 					if node in condition:
 						blocked = True
-						temp_path = copy.deepcopy(path)  # unique copies per path
-						temp_path.set_blocked_node(j)
-						blocked_paths.append(temp_path)
+						path.set_blocked_node(j)
+						blocked_paths.append(path)
 						break
-				elif link_type == Link.COLLIDER:
-					nodes = set([node]).union(self.get_descendants(node))
-					if len(condition.intersection(nodes)) == 0:
+				else:
+					# collider
+					k = node.id
+					if not (1 << k | descendants[k]) & observed:
 						blocked = True
-						temp_path = copy.deepcopy(path)  #
-						temp_path.set_blocked_node(j)
-						blocked_paths.append(temp_path)
+						path.set_blocked_node(j)
+						blocked_paths.append(path)
 						break
 
 			if not blocked:
 				open_paths.append(path)
-				#return True, (open_paths, blocked_paths)
+				if stop_at_open:
+					break
 
 		# none of the paths turned out to be unblocked
 		return open_paths, blocked_paths
 
-	def conditionally_independent(self, node1, node2, condition=None, verbose=False):
-		open_paths, blocked_paths = self.conditional_paths(node1, node2, condition)
-		if len(open_paths) == 0:
-			indep = True
-		else:
+	def conditionally_independent(self, node1, node2, condition=None, verbose=False, witness=False):
+		"""
+		d-separation test by reachability. Enumerating paths takes exponential time, so
+		witnesses are only returned, as indep, (open_paths, blocked_paths), if witness is
+		True: all blocked paths if independent, otherwise the first open path found and the
+		blocked paths generated before it.
+		"""
+		if str(node1) == str(node2):
 			indep = False
+		else:
+			indep = str(node2) not in self.reachable(node1, condition)
+
+		if witness:
+			open_paths, blocked_paths = self.conditional_paths(node1, node2, condition, stop_at_open=True)
 
 		if verbose:
 			print(f"{node1} and {node2} are{"" if indep else " not"} independent conditioned on {condition}.")
-			if not indep:
-				print(f"{len(open_paths)} open paths. "
-				      f"Example: {open_paths[random.randint(0, len(open_paths)-1)]}")
-		return indep, (open_paths, blocked_paths)
+			if not indep and witness:
+				print(f"Open path: {open_paths[0]}")
+
+		if witness:
+			return indep, (open_paths, blocked_paths)
+		return indep
+
+
+def _csr_extend(csr, sources, targets):
+	# new CSR pair with targets[k] appended to the neighbours of sources[k], after the existing
+	# ones and in the order given
+	ptr, ids = csr
+	if not sources:
+		return csr
+
+	added = [0] * (len(ptr) - 1)
+	for i in sources:
+		added[i] += 1
+
+	new_ptr = array('l', [0])
+	new_ids = array('l', [0]) * (len(ids) + len(targets))
+	fill = []
+	shift = 0
+	for i in range(len(added)):
+		start = new_ptr[i]
+		new_ids[start:start + ptr[i + 1] - ptr[i]] = ids[ptr[i]:ptr[i + 1]]
+		fill.append(start + ptr[i + 1] - ptr[i])
+		shift += added[i]
+		new_ptr.append(ptr[i + 1] + shift)
+
+	for i, j in zip(sources, targets):
+		new_ids[fill[i]] = j
+		fill[i] += 1
+
+	return new_ptr, new_ids
 
 
 class Node:
-	def __init__(self, name):
+	"""
+	Node id of graph. The relatives are not stored here but read from the graph's adjacency
+	arrays, as names in the order the edges were added.
+	"""
+	__slots__ = ('name', 'id', 'graph', 'blocked')
+
+	def __init__(self, name, graph: DAG, node_id):
 		self.name = name
-		self.children = []
-		self.parents = []
+		self.id = node_id
+		self.graph = graph
 		self.blocked = False
 
-	def add_child(self, child: 'Node'):
-		self.children.append(child)
+	def _relatives(self, relation):
+		ptr, ids = relation
+		nodes = self.graph._node_list
+		return [nodes[j].name for j in ids[ptr[self.id]:ptr[self.id + 1]]]
 
-	def add_parent(self, child: 'Node'):
-		self.parents.append(child)
+	@property
+	def children(self):
+		return self._relatives(self.graph._children)
+
+	@property
+	def parents(self):
+		return self._relatives(self.graph._parents)
+
+	def add_child(self, child: 'Node | str'):
+		self.graph.add_edges([(self.name, str(child))])
+
+	def add_parent(self, parent: 'Node | str'):
+		self.graph.add_edges([(str(parent), self.name)])
 
 	def get_relatives(self):
 		return self.children + self.parents
@@ -218,14 +492,17 @@ class Node:
 		return self.name
 
 class Path:
-	def __init__(self, path, parent_graph: DAG):
+	def __init__(self, path, parent_graph: DAG, edges=None):
 		self.path = path
 		self.parent_graph = parent_graph
 		self.edges = []
 		self.blocked_node_index = -1
 
 		# routines
-		self.assign_edges()
+		if edges is None:
+			self.assign_edges()
+		else:
+			self.edges = edges
 
 	def assign_edges(self):
 		for i in range(len(self.path)-1):
@@ -236,6 +513,8 @@ class Path:
 
 	def set_blocked_node(self, index):
 		self.blocked_node_index = index
+		# the nodes are shared with the graph and other paths
+		self.path[index] = copy.copy(self.path[index])
 		self.path[index].blocked = True
 
 	def __str__(self):
@@ -5,19 +5,16 @@ def test_hypotheses(graph, hypothesis_list):
 		conditionals = set(conditionals)
 
 		if conditionals.issubset(set(nodes)):
-			overall_independence = True
-			for node1 in nodes1:
-				for node2 in nodes2:
-					if node1 == node2:
-						continue
-					indep, paths = graph.conditionally_independent(node1, node2, conditionals) #, verbose=True)
-					if not indep:
-						overall_independence = False
+			independence = graph.independence_matrix(nodes1, nodes2, conditionals)
+			overall_independence = all(indep
+			                           for node1, row in zip(nodes1, independence)
+			                           for node2, indep in zip(nodes2, row)
+			                           if node1 != node2)
 			print(f"{nodes1} and {nodes2} are{"" if overall_independence else " not"} independent conditioned on {conditionals}.")
 		else:
 			print("Some conditionals are not part of the graph.")
 
-	return indep, paths
+	return overall_independence
 
 if __name__ == '__main__':
 	drivers = [f"A{i}" for i in range(1, 4)]
@@ -71,6 +68,6 @@ if __name__ == '__main__':
 	]
 
 	graph = digraph.DAG(nodes, edges)
-	indep, (open_paths, closed_paths) = test_hypotheses(graph, test)
+	indep = test_hypotheses(graph, test)
 
 	graph.view()
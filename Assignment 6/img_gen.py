@@ -1,3 +1,4 @@
+from numba import njit
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 
@@ -44,3 +45,49 @@ def add_noise(img, noise):
 	noisy_img = img * -noise
 
 	return noisy_img
+
+
+@njit(cache=True)
+def _flip_sample(img, flip_count, rng):
+	"""
+	Flips exactly flip_count pixels of img in place, drawn uniformly without replacement by
+	selection sampling (Knuth's Algorithm S): one pass, one draw per pixel, no index array
+	"""
+	rows, cols = img.shape
+	remaining = rows * cols
+	for r in range(rows):
+		for c in range(cols):
+			if flip_count == 0:
+				return img
+			if rng.random() * remaining < flip_count:
+				img[r, c] = -img[r, c]
+				flip_count -= 1
+			remaining -= 1
+
+	return img
+
+
+def add_noise_inplace(img, frequency, rng=None):
+	"""
+	Flips int(frequency * img.size) random pixels of the int8 image img in place and returns
+	it. rng: a np.random.Generator or a seed for np.random.default_rng
+	"""
+	rng = np.random.default_rng(rng)
+	return _flip_sample(img, int(frequency * img.size), rng)
+
+
+def noisy_batch(img, frequency, n, seed=None, out=None):
+	"""
+	(n, H, W) int8 stack of independently noised copies of img, written into out if given.
+	The same seed always gives the same stack.
+	"""
+	if out is None:
+		out = np.empty((n,) + img.shape, dtype=np.int8)
+
+	rng = np.random.default_rng(seed)
+	flip_count = int(frequency * img.size)
+	for noisy in out[:n]:
+		noisy[...] = img
+		_flip_sample(noisy, flip_count, rng)
+
+	return out
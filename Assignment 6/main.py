@@ -8,7 +8,6 @@ plt.ion()
 import mrf
 import numpy as np
 import time
-import tqdm
 
 if __name__ == '__main__':
 	gt = img_gen.gen_image()
@@ -28,7 +27,7 @@ if __name__ == '__main__':
 	# region Starting Point
 	starting_points = [(0, 0), (217, 189), (367, 125), (385, 388)]  # xy
 	imgs_denoised_ifo_sp = [mrf.optimise_local_jit(noisy_img, start=c) for c in starting_points]
-	scores = [mrf.prec_recall_f1(gt, fit) for fit in imgs_denoised_ifo_sp]
+	scores = mrf.prec_recall_f1_batch(gt, np.stack(imgs_denoised_ifo_sp))
 
 	fig, ax = plt.subplots(2, 3, sharex=True, sharey=True)
 	fig.suptitle('Effect of starting point')
@@ -147,13 +146,7 @@ if __name__ == '__main__':
 
 	# region Hyperparameter optimisation (/mapping)
 	b_rng, c_rng = np.arange(0, 4 + 0.1, 0.25), np.arange(0, 4 + 0.1, 0.25)
-	bs, cs = np.meshgrid(b_rng, c_rng)
-	f1s = np.empty_like(bs)
-
-	for i, (b, c) in tqdm.tqdm(enumerate(zip(bs.flatten(), cs.flatten())), total=bs.size):
-		observed = mrf.optimise_local_jit(noisy_img, (1, b, c))
-		_, _, f1 = mrf.prec_recall_f1(gt, observed)
-		f1s[np.unravel_index(i, f1s.shape)] = f1
+	f1s = mrf.sweep_params(noisy_img, gt, 1, b_rng, c_rng)
 
 	fig, ax = plt.subplots(1, 1)
 	data = ax.pcolormesh(b_rng, c_rng, f1s, vmin=0, vmax=1)
@@ -182,11 +175,8 @@ if __name__ == '__main__':
 	noisy_imgs = [img_gen.add_noise(im, noise) for im in gts]
 
 	# get F1
-	scores = []
-	for gt, im in zip(gts, noisy_imgs):
-		guess = mrf.optimise_local_jit(im, (1, 2, 1))
-		score = mrf.prec_recall_f1(gt, guess)
-		scores.append(score)
+	guesses, _ = mrf.denoise_batch(np.stack(noisy_imgs), (1, 2, 1))
+	scores = [mrf.prec_recall_f1(gt, guess) for gt, guess in zip(gts, guesses)]
 
 	scores = np.array(scores).T
 	fig, ax = plt.subplots(2, 2)
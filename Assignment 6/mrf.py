@@ -1,6 +1,13 @@
-from numba import njit
+from numba import njit, prange, types, vectorize
+from numba.extending import overload
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import heapq
+import itertools
 import numpy as np
-import tqdm
+
+TILE_SIZE = 64  # edge length of the square tiles visited by order 'tiled'
+FOUR_NEIGHBOURS = ((-1, 0), (1, 0), (0, -1), (0, 1))
 
 
 def get_valid_neighbours(co, shape):
@@ -14,88 +21,713 @@ def get_valid_neighbours(co, shape):
 	return n
 
 
-@njit
-def _jit_optimise_core(guess, observed, idx, a, b, c, neighbours_mx, max_iters=100):
+@vectorize(['uint64(uint64)'], cache=True)
+def _pixel_key(i):
+	"""
+	Zobrist key of a raveled pixel index (splitmix64 finaliser), so no key table is needed
+	"""
+	z = i + np.uint64(0x9E3779B97F4A7C15)
+	z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+	z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+	return z ^ (z >> np.uint64(31))
+
+
+@njit(cache=True)
+def image_hash(img):
+	"""
+	64-bit Zobrist hash of a +-1 image: XOR of the keys of all +1 pixels (C order raveled).
+	Flipping a pixel toggles its key, so the hash can be maintained per flip.
+	"""
+	rows, cols = img.shape
+	h = np.uint64(0)
+	for r in range(rows):
+		for c_idx in range(cols):
+			if img[r, c_idx] > 0:
+				h ^= _pixel_key(np.uint64(r * cols + c_idx))
+
+	return h
+
+
+@njit('uint64(uint8[:, :], intp)', cache=True)
+def label_hash(labels, n_labels):
+	"""
+	64-bit Zobrist hash of a label map: XOR of the keys of all (pixel, label) pairs, so
+	relabelling a pixel toggles two keys.
+	"""
+	rows, cols = labels.shape
+	h = np.uint64(0)
+	for r in range(rows):
+		for c_idx in range(cols):
+			h ^= _pixel_key(np.uint64((r * cols + c_idx) * n_labels + labels[r, c_idx]))
+
+	return h
+
+
+@njit('intp(uint64[:], intp)', cache=True)
+def _cycle_length(hashes, n):
+	"""
+	Number of sweeps since the state hashed in hashes[n] was last seen (0 if it is new)
+	"""
+	for k in range(n - 1, -1, -1):
+		if hashes[k] == hashes[n]:
+			return n - k
+
+	return 0
+
+
+class ConvergenceTracker:
+	"""
+	Detects fixed points and cycles without keeping earlier images around: only one 64-bit
+	hash per sweep is stored, and the hash is updated from the flipped pixels.
+	A cycle length of 1 means the optimiser reached a fixed point.
+	For label maps (n_labels given) the keys of (pixel, label) pairs are hashed instead.
+	"""
+
+	def __init__(self, img, n_labels=None):
+		self.hash = int(image_hash(img) if n_labels is None else label_hash(img, n_labels))
+		self.sweeps = 0
+		self.cycle_length = 0
+		self._seen = {self.hash: 0}
+
+	def update(self, flipped):
+		"""
+		Registers a sweep from the (C order) raveled indices of the pixels it flipped, or for
+		label maps the indices pixel * n_labels + label of the old and new labels.
+		Returns True once the image is back in a previously seen state.
+		"""
+		self.sweeps += 1
+		if len(flipped):
+			keys = _pixel_key(np.asarray(flipped, dtype=np.uint64))
+			self.hash ^= int(np.bitwise_xor.reduce(keys))
+
+		prev = self._seen.get(self.hash)
+		if prev is not None:
+			self.cycle_length = self.sweeps - prev
+			return True
+
+		self._seen[self.hash] = self.sweeps
+		return False
+
+
+def _at(x, r, c_idx):
+	"""
+	x[r, c_idx] for per-pixel parameter arrays, x itself for scalars
+	"""
+	return x[r, c_idx] if np.ndim(x) else x
+
+
+@overload(_at)
+def _at_jit(x, r, c_idx):
+	# resolved at compile time, so the scalar case compiles to the plain scalar kernel
+	if isinstance(x, types.Array):
+		return lambda x, r, c_idx: x[r, c_idx]
+	return lambda x, r, c_idx: x
+
+
+def neighbourhood(radius=1):
+	"""
+	Offset table of all pixels within Euclidean distance radius: 1 gives the 4-neighbourhood,
+	sqrt(2) the 8-neighbourhood and 2 a radius-2 stencil.
+	"""
+	reach = int(np.floor(radius))
+	return tuple((dr, dc)
+	             for dr in range(-reach, reach + 1)
+	             for dc in range(-reach, reach + 1)
+	             if 0 < dr ** 2 + dc ** 2 <= radius ** 2)
+
+
+def _neighbourhood(neighbours=None, weights=None):
+	"""
+	Neighbour offset table and per-offset weights of the coupling b, defaulting to the
+	4-neighbourhood with unit weights. Each offset must come with its opposite, of equal
+	weight, for the flip energies to belong to a total energy.
+	"""
+	neighbours_mx = np.array(FOUR_NEIGHBOURS if neighbours is None else neighbours, dtype=np.int32).reshape(-1, 2)
+	if weights is None:
+		weights = np.ones(len(neighbours_mx))
+	else:
+		weights = np.broadcast_to(np.asarray(weights, dtype=np.float64), (len(neighbours_mx),)).copy()
+
+	pairs = {(dr, dc): w for (dr, dc), w in zip(neighbours_mx.tolist(), weights)}
+	if (0, 0) in pairs or any(pairs.get((-dr, -dc)) != w for (dr, dc), w in pairs.items()):
+		raise ValueError("The neighbourhood must be symmetric and exclude the pixel itself")
+
+	return neighbours_mx, weights
+
+
+@njit(cache=True)
+def _flip_delta(guess, observed, r, c_idx, a, b, c, neighbours_mx, weights):
+	"""
+	Change in energy when pixel (r, c_idx) is flipped:
+	-2 * x * (a - c * y - b * sum(weight * neighbour))
+	a and c are either scalars or per-pixel arrays.
+	"""
+	rows, cols = guess.shape
+	neigh_sum = 0.0
+	for i in range(neighbours_mx.shape[0]):
+		nr, nc = r + neighbours_mx[i, 0], c_idx + neighbours_mx[i, 1]
+		if 0 <= nr < rows and 0 <= nc < cols:
+			neigh_sum += weights[i] * guess[nr, nc]
+
+	unary = _at(a, r, c_idx) - _at(c, r, c_idx) * observed[r, c_idx]
+	return -2.0 * guess[r, c_idx] * (unary - b * neigh_sum)
+
+
+@njit(nogil=True, cache=True)
+def _jit_optimise_core(guess, observed, idx, a, b, c, neighbours_mx, weights, max_iters=100):
 	"""
 	The JIT-compiled core logic.
 	Focuses on the high-speed pixel-flipping loops.
 	"""
 	rows, cols = observed.shape
-	history = [np.copy(guess)]  # Limited list support in Numba
 
-	for _ in range(max_iters):
-		changed = False
+	# Convergence check: one hash per sweep instead of a copy of every image
+	hashes = np.zeros(max_iters + 1, dtype=np.uint64)
+	hashes[0] = image_hash(guess)
+	h = hashes[0]
+
+	# energy relative to the start after every sweep, accumulated from the flips
+	change = np.zeros(max_iters + 1)
+	e = 0.0
+
+	sweeps, cycle_length = 0, 0
+	while sweeps < max_iters and cycle_length == 0:
+		sweeps += 1
 		for px in idx:
 			# Manually unravel index for performance in JIT
 			r = px % rows
 			c_idx = px // rows
 
-			# Local energy calculations
-			# Current value and flipped value
-			val_curr = guess[r, c_idx]
-			val_alt = -val_curr
+			delta = _flip_delta(guess, observed, r, c_idx, a, b, c, neighbours_mx, weights)
+			if delta < 0:
+				guess[r, c_idx] = -guess[r, c_idx]
+				h ^= _pixel_key(np.uint64(r * cols + c_idx))
+				e += delta
 
-			# Energy component from observation
-			energy_diff_obs = (val_alt - val_curr) * (a - c * observed[r, c_idx])
+		hashes[sweeps] = h
+		change[sweeps] = e
+		cycle_length = _cycle_length(hashes, sweeps)
 
-			# Energy component from neighbours
-			energy_diff_neigh = 0.0
-			for i in range(4):
-				nr, nc = r + neighbours_mx[i, 0], c_idx + neighbours_mx[i, 1]
-				if 0 <= nr < rows and 0 <= nc < cols:
-					# Difference in interaction energy: -b * (alt*neigh - curr*neigh)
-					energy_diff_neigh += -b * (val_alt - val_curr) * guess[nr, nc]
-
-			if (energy_diff_obs + energy_diff_neigh) < 0:
-				guess[r, c_idx] = val_alt
-				changed = True
-
-		# Convergence Check: Compare against history
-		# Note: Numba handles this best with explicit array comparisons
-		is_periodic = False
-		for prev in history:
-			if np.array_equal(guess, prev):
-				is_periodic = True
-				break
-
-		if is_periodic or not changed:
-			break
+	return guess, sweeps, cycle_length, change[:sweeps + 1]
 
-		history.append(np.copy(guess))
 
-	return guess
+@njit(nogil=True, cache=True)
+def _jit_incremental_core(guess, observed, idx, a, b, c, neighbours_mx, weights, max_iters=100):
+	"""
+	Active-set variant of _jit_optimise_core. The first sweep visits every pixel, later
+	sweeps only the dirty ones: pixels with a neighbour that flipped since their last visit.
+	Dirty pixels are visited in traversal order (min-heap on their position in idx), so the
+	result is identical to that of full sweeps, at a cost proportional to the number of flips.
+	"""
+	rows, cols = observed.shape
+	positions = np.empty(idx.size, dtype=np.int64)
+	positions[idx] = np.arange(idx.size)
+	queued = np.zeros(idx.size, dtype=np.bool_)
 
+	hashes = np.zeros(max_iters + 1, dtype=np.uint64)
+	hashes[0] = image_hash(guess)
+	h = hashes[0]
 
-def optimise_local_jit(observed, params=(1, 1, 1), start=(0, 0), order='H'):
-	a, b, c = params
+	# energy relative to the start after every sweep, accumulated from the flips
+	change = np.zeros(max_iters + 1)
+	e = 0.0
 
-	neighbours_mx = np.array([[-1, 0], [1, 0], [0, -1], [0, 1]], dtype=np.int32)
+	# min-heaps of positions in idx left to visit in this sweep and in the next one
+	current = [np.int64(0)]
+	current.pop()
+	upcoming = [np.int64(0)]
+	upcoming.pop()
 
-	if order == 'V':
-		observed = observed.T
+	sweeps, cycle_length = 0, 0
+	while sweeps < max_iters and cycle_length == 0:
+		sweeps += 1
+		k = 0
+		while True:
+			if sweeps == 1:
+				if k == idx.size:
+					break
+				pos = np.int64(k)
+				k += 1
+			else:
+				if len(current) == 0:
+					break
+				pos = heapq.heappop(current)
+				queued[pos] = False
+
+			px = idx[pos]
+			r = px % rows
+			c_idx = px // rows
+
+			delta = _flip_delta(guess, observed, r, c_idx, a, b, c, neighbours_mx, weights)
+			if delta < 0:
+				guess[r, c_idx] = -guess[r, c_idx]
+				h ^= _pixel_key(np.uint64(r * cols + c_idx))
+				e += delta
+
+				# Neighbours still ahead are revisited in this sweep, those behind in the next.
+				# The pixel itself is not: flipping it back raises the energy unless a neighbour
+				# changes, and then it is queued anyway.
+				for i in range(neighbours_mx.shape[0]):
+					nr, nc = r + neighbours_mx[i, 0], c_idx + neighbours_mx[i, 1]
+					if 0 <= nr < rows and 0 <= nc < cols:
+						n_pos = positions[nr + nc * rows]
+						if n_pos > pos:
+							# the first sweep gets there regardless
+							if sweeps > 1 and not queued[n_pos]:
+								queued[n_pos] = True
+								heapq.heappush(current, n_pos)
+						elif not queued[n_pos]:
+							queued[n_pos] = True
+							upcoming.append(n_pos)
+
+		hashes[sweeps] = h
+		change[sweeps] = e
+		cycle_length = _cycle_length(hashes, sweeps)
+
+		heapq.heapify(upcoming)
+		current, upcoming = upcoming, current
+
+	return guess, sweeps, cycle_length, change[:sweeps + 1]
+
+
+@njit(parallel=True, cache=True)
+def _jit_checkerboard_core(guess, observed, a, b, c, neighbours_mx, weights, max_iters=100):
+	"""
+	Red-black ICM. With 4-neighbour coupling a pixel only interacts with pixels of the
+	opposite checkerboard colour, so all pixels of one colour can be updated at once and
+	the result is identical to a sequential sweep over that colour.
+	"""
+	rows, cols = observed.shape
+	change = np.zeros(max_iters + 1)
+
+	sweeps, cycle_length = 0, 0
+	while sweeps < max_iters and cycle_length == 0:
+		sweeps += 1
+		changed = 0
+		e = 0.0
+		for colour in range(2):
+			for r in prange(rows):
+				for c_idx in range((r + colour) % 2, cols, 2):
+					delta = _flip_delta(guess, observed, r, c_idx, a, b, c, neighbours_mx, weights)
+					if delta < 0:
+						guess[r, c_idx] = -guess[r, c_idx]
+						changed += 1
+						e += delta
+		change[sweeps] = change[sweeps - 1] + e
+
+		# every colour update lowers the energy, so the only possible cycle is a fixed point
+		if changed == 0:
+			cycle_length = 1
+
+	return guess, sweeps, cycle_length, change[:sweeps + 1]
+
+
+@njit(cache=True)
+def _uniform(seed, sweep, i):
+	# counter-based uniform in [0, 1): the draw for pixel i in a sweep does not depend on which
+	# thread makes it, so results are reproducible for any number of threads
+	stream = _pixel_key(np.uint64(seed) ^ _pixel_key(np.uint64(sweep)))
+	return (_pixel_key(stream ^ np.uint64(i)) >> np.uint64(11)) * (1.0 / 9007199254740992.0)
+
+
+@njit(parallel=True, cache=True)
+def _jit_gibbs_core(guess, observed, a, b, c, neighbours_mx, weights, temperatures, burn_in, seed):
+	"""
+	Red-black Gibbs sampler, one sweep per temperature. Given its neighbours a pixel is +1
+	with probability 1 / (1 + exp(2 * u / T)), u = a - c * y - b * sum(weight * neighbour);
+	T = 0 is a greedy (ICM) sweep. Counts how often every pixel is +1 after burn_in sweeps.
+	"""
+	rows, cols = observed.shape
+	n_sweeps = temperatures.size
+	counts = np.zeros((rows, cols), dtype=np.int64)
+	change = np.zeros(n_sweeps + 1)
+
+	for sweep in range(n_sweeps):
+		t = temperatures[sweep]
+		e = 0.0
+		for colour in range(2):
+			for r in prange(rows):
+				for c_idx in range((r + colour) % 2, cols, 2):
+					delta = _flip_delta(guess, observed, r, c_idx, a, b, c, neighbours_mx, weights)
+					if t > 0:
+						u = -0.5 * delta * guess[r, c_idx]
+						flip = _uniform(seed, sweep, r * cols + c_idx) * (1.0 + np.exp(2.0 * u / t)) < 1.0
+						flip = flip != (guess[r, c_idx] == 1)
+					else:
+						flip = delta < 0
+					if flip:
+						guess[r, c_idx] = -guess[r, c_idx]
+						e += delta
+		change[sweep + 1] = change[sweep] + e
+
+		if sweep >= burn_in:
+			for r in prange(rows):
+				for c_idx in range(cols):
+					if guess[r, c_idx] == 1:
+						counts[r, c_idx] += 1
+
+	return guess, counts, change
+
+
+def _morton_keys(r, c):
+	# interleave the bits of row and column
+	keys = np.zeros(r.shape, dtype=np.int64)
+	for bit in range(int(max(r.max(), c.max())).bit_length()):
+		keys |= ((r >> bit) & 1) << (2 * bit + 1)
+		keys |= ((c >> bit) & 1) << (2 * bit)
 
+	return keys
+
+
+def _hilbert_keys(r, c):
+	# distance along the Hilbert curve filling the smallest enclosing power-of-two square
+	n = 1 << int(max(r.max(), c.max())).bit_length()
+	x, y = c.copy(), r.copy()
+	keys = np.zeros(r.shape, dtype=np.int64)
+	s = n // 2
+	while s > 0:
+		rx = (x & s) > 0
+		ry = (y & s) > 0
+		keys += s * s * ((3 * rx) ^ ry)
+
+		# rotate the quadrant
+		flip = rx & ~ry
+		x = np.where(flip, n - 1 - x, x)
+		y = np.where(flip, n - 1 - y, y)
+		x, y = np.where(ry, x, y), np.where(ry, y, x)
+		s //= 2
+
+	return keys
+
+
+@functools.lru_cache(maxsize=16)
+def _base_ordering(shape, order):
+	"""
+	Visiting order of all pixels of an image of the given shape, built once per shape and
+	order. Pixel indices are raveled column-major, as unravelled by the JIT kernels, so
+	'H' is the plain arange and 'V' (along the rows in memory) needs no transpose.
+	"""
+	rows, cols = shape
 	if order == 'D':
-		idx = get_diagonal_raveled_indices(observed).astype(np.int64)
+		idx = get_diagonal_raveled_indices(np.empty(shape, dtype=np.int8)).astype(np.int64)
+	elif order in ('V', 'tiled', 'zorder', 'hilbert'):
+		r, c = np.indices(shape, dtype=np.int64).reshape(2, -1)
+		if order == 'V':
+			perm = np.arange(r.size)
+		elif order == 'tiled':
+			# tile by tile, each tile in memory order
+			perm = np.lexsort((c, r, c // TILE_SIZE, r // TILE_SIZE))
+		elif order == 'zorder':
+			perm = np.argsort(_morton_keys(r, c), kind='stable')
+		else:
+			perm = np.argsort(_hilbert_keys(r, c), kind='stable')
+		idx = (r + c * rows)[perm]
 	else:
-		idx = np.arange(observed.size, dtype=np.int64)
+		idx = np.arange(rows * cols, dtype=np.int64)
+
+	idx.setflags(write=False)
+	return idx
+
+
+def _traversal_indices(shape, order='H', start=(0, 0)):
+	"""
+	Pixel indices in visiting order, raveled column-major as unravelled by the JIT kernels
+	"""
+	idx = _base_ordering(tuple(shape), order)
 
 	if order == 'random':
-		np.random.shuffle(idx)
+		idx = np.random.permutation(idx)
 
-	start_idx = start[0] + start[1] * observed.shape[1]
-	idx = np.roll(idx, -start_idx)  # Roll left to start at specific index
+	# start is counted along the traversed lines, which for 'V' are the columns
+	start_idx = start[0] + start[1] * (shape[0] if order == 'V' else shape[1])
+	return np.roll(idx, -start_idx)  # Roll left to start at specific index
 
-	guess = np.copy(observed)
-	result = _jit_optimise_core(guess, observed, idx, a, b, c, neighbours_mx)
 
-	# 3. Finalize Output
-	if order == 'V':
-		result = result.T
+@njit(parallel=True, cache=True)
+def _jit_batch_core(guesses, stack, idx, a, b, c, neighbours_mx, weights, max_iters=100):
+	"""
+	Denoises every image of the stack on its own thread. guesses is updated in place.
+	"""
+	iterations = np.zeros(stack.shape[0], dtype=np.int64)
+	for n in prange(stack.shape[0]):
+		# the incremental kernel gives the same result as full sweeps, only faster
+		_, iterations[n], _, _ = _jit_incremental_core(
+			guesses[n], stack[n], idx, a, b, c, neighbours_mx, weights, max_iters)
+
+	return iterations
+
+
+@njit(parallel=True, cache=True)
+def _jit_sweep_core(observed, gt, idx, a, b_values, c_values, neighbours_mx, weights, max_iters=100, warm_start=False):
+	"""
+	Solves for every (b, c) pair and scores it against gt straight away, so only the confusion
+	counts are kept. Cold starts give every pair its own parallel iteration; with warm_start
+	every c is a chain through b_values, each solve starting from the result for the previous b.
+	Returns a (len(c_values), len(b_values), 4) array of tp, tn, fp, fn.
+	"""
+	n_b = b_values.size
+	counts = np.zeros((c_values.size, n_b, 4), dtype=np.int64)
+	chain_length = n_b if warm_start else 1
+	chains_per_c = 1 if warm_start else n_b
+	for k in prange(c_values.size * chains_per_c):
+		j, first = divmod(np.int64(k), chains_per_c)
+		first *= chain_length
+		guess = np.copy(observed)
+		for i in range(first, first + chain_length):
+			_jit_incremental_core(guess, observed, idx, a, b_values[i], c_values[j], neighbours_mx, weights, max_iters)
+			counts[j, i, 0], counts[j, i, 1], counts[j, i, 2], counts[j, i, 3] = _confusion_counts(gt, guess)
+
+	return counts
 
+
+def _initial_guess(observed, init):
+	# int8 copy of init (or observed) to optimise in place; the kernels take the image size
+	# from observed and do not bounds-check the guess
+	guess = np.copy(observed) if init is None else np.array(init, dtype=np.int8)
+	if guess.shape != observed.shape:
+		raise ValueError(f"init has shape {guess.shape}, expected {observed.shape}")
+
+	return guess
+
+
+def optimise_local_jit(observed, params=(1, 1, 1), start=(0, 0), order='H', max_iters=100, incremental=False,
+                       init=None, neighbours=None, weights=None, return_info=False):
+	"""
+	params: (a, b, c); a and c may also be per-pixel arrays
+	incremental: only revisit pixels next to a flip after the first sweep. Same result, but
+	later sweeps cost about as much as the number of flips instead of the image size.
+	init: initial guess, the observed image if None
+	neighbours, weights: neighbour offsets (see neighbourhood()) and the weight of b for each
+	"""
+	a, b, c = params
+
+	neighbours_mx, weights = _neighbourhood(neighbours, weights)
+
+	guess = _initial_guess(observed, init)
+	initial_energy = energy(guess, observed, params, neighbours_mx, weights) if return_info else None
+	if order == 'checkerboard':
+		if incremental:
+			raise ValueError("Incremental mode needs a sequential traversal order")
+		if np.any(neighbours_mx.sum(axis=1) % 2 == 0):
+			raise ValueError("Checkerboard updates need a neighbourhood that only couples opposite colours")
+		# start is irrelevant here: every pixel of a colour is updated simultaneously
+		result, sweeps, cycle_length, change = _jit_checkerboard_core(
+			guess, observed, a, b, c, neighbours_mx, weights, max_iters)
+	else:
+		idx = _traversal_indices(observed.shape, order, start)
+		core = _jit_incremental_core if incremental else _jit_optimise_core
+		result, sweeps, cycle_length, change = core(guess, observed, idx, a, b, c, neighbours_mx, weights, max_iters)
+
+	if return_info:
+		# energy after every sweep, starting from that of the initial guess
+		trace = initial_energy + change
+		return result, {'iterations': sweeps, 'cycle_length': cycle_length, 'energy': trace}
 	return result
 
 
-def optimise_local(observed, params=(1, 1, 1), start=(0, 0), order='H'):
+def _downsample_majority(img):
+	"""
+	Halves both dimensions: every coarse pixel takes the majority of its 2x2 block, with ties
+	going to the top-left pixel. Odd edges are padded by replication.
+	"""
+	rows, cols = img.shape
+	padded = np.pad(img, ((0, rows % 2), (0, cols % 2)), mode='edge')
+	blocks = padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2)
+	votes = blocks.sum(axis=(1, 3))
+
+	return np.where(votes == 0, blocks[:, 0, :, 0], np.sign(votes)).astype(np.int8)
+
+
+def _upsample(img, shape):
+	return np.repeat(np.repeat(img, 2, axis=0), 2, axis=1)[:shape[0], :shape[1]]
+
+
+def optimise_pyramid(observed, params=(1, 1, 1), levels=3, order='H', incremental=True, return_info=False):
+	"""
+	Coarse-to-fine ICM. The observation is halved levels - 1 times by majority vote; the
+	coarsest level is solved from its observation and every finer level starts from the
+	upsampled solution of the level below, so it mostly has to refine edges.
+	All levels use the same params: the majority vote already makes coarse observations less
+	noisy, and weakening the coupling there to match block energies gave worse minima.
+	"""
+	pyramid = [observed]
+	while len(pyramid) < levels and min(pyramid[-1].shape) > 1:
+		pyramid.append(_downsample_majority(pyramid[-1]))
+
+	guess = None
+	iterations = []
+	for k in range(len(pyramid) - 1, -1, -1):
+		init = None if guess is None else _upsample(guess, pyramid[k].shape)
+		guess, info = optimise_local_jit(pyramid[k], params, order=order, incremental=incremental,
+		                                 init=init, return_info=True)
+		iterations.append(info['iterations'])
+
+	if return_info:
+		# sweeps per level, coarsest first
+		return guess, {'iterations': iterations}
+	return guess
+
+
+def optimise_multistart(observed, params=(1, 1, 1), starts=((0, 0),), orders=('H',), max_iters=100, incremental=False,
+                        init=None, neighbours=None, weights=None, max_workers=None):
+	"""
+	Runs sequential ICM for every combination of start and order on a thread pool (the
+	kernels release the GIL) and keeps the labelling of lowest energy.
+	Returns (best, runs) with runs a list of {'start', 'order', 'energy', 'iterations',
+	'cycle_length'} dicts, one per combination.
+	"""
+	a, b, c = params
+	if 'checkerboard' in orders:
+		raise ValueError("Multi-start needs sequential traversal orders")
+
+	neighbours_mx, weights = _neighbourhood(neighbours, weights)
+
+	guess = _initial_guess(observed, init)
+	initial_energy = energy(guess, observed, params, neighbours_mx, weights)
+	core = _jit_incremental_core if incremental else _jit_optimise_core
+
+	# orders are generated here, as 'random' draws from the global random state
+	combinations = list(itertools.product(starts, orders))
+	indices = [_traversal_indices(observed.shape, order, start) for start, order in combinations]
+
+	def run(idx):
+		return core(guess.copy(), observed, idx, a, b, c, neighbours_mx, weights, max_iters)
+
+	with ThreadPoolExecutor(max_workers) as pool:
+		results = list(pool.map(run, indices))
+
+	runs = [{'start': start, 'order': order, 'energy': initial_energy + change[-1], 'iterations': sweeps,
+	         'cycle_length': cycle_length}
+	        for (start, order), (_, sweeps, cycle_length, change) in zip(combinations, results)]
+	best = min(range(len(runs)), key=lambda i: runs[i]['energy'])
+
+	return results[best][0], runs
+
+
+def denoise_batch(stack, params=(1, 1, 1), start=(0, 0), order='H', max_iters=100, init=None, neighbours=None,
+                  weights=None):
+	"""
+	Sequential ICM on every image of an (N, H, W) stack in one parallel JIT call.
+	Equivalent to optimise_local_jit per image; order 'random' shares one permutation.
+	init: (N, H, W) stack of initial guesses, the observed images if None
+	Returns the denoised stack and the number of sweeps per image.
+	"""
+	a, b, c = params
+
+	stack = np.asarray(stack, dtype=np.int8)
+	if stack.ndim != 3:
+		raise ValueError(f"Expected an (N, H, W) stack, got shape {stack.shape}")
+	if order == 'checkerboard':
+		raise ValueError("Batches are parallelised over images and need a sequential traversal order")
+
+	neighbours_mx, weights = _neighbourhood(neighbours, weights)
+
+	idx = _traversal_indices(stack.shape[1:], order, start)
+
+	guesses = _initial_guess(stack, init)
+	iterations = _jit_batch_core(guesses, stack, idx, a, b, c, neighbours_mx, weights, max_iters)
+
+	return guesses, iterations
+
+
+def sweep_params(observed, gt, a, b_values, c_values, start=(0, 0), order='H', max_iters=100, warm_start=False,
+                 neighbours=None, weights=None):
+	"""
+	F1 score of optimise_local_jit(observed, (a, b, c)) for every b in b_values and c in
+	c_values, with the grid fanned out over all cores.
+	warm_start: seed every solve with the result for the previous b (continuation). Much
+	cheaper, but as ICM finds local minima the scores can differ from cold starts.
+	Returns an array of shape (len(c_values), len(b_values)), as laid out by np.meshgrid.
+	"""
+	if order == 'checkerboard':
+		raise ValueError("Sweeps are parallelised over parameters and need a sequential traversal order")
+
+	neighbours_mx, weights = _neighbourhood(neighbours, weights)
+
+	idx = _traversal_indices(observed.shape, order, start)
+
+	b_values = np.asarray(b_values, dtype=np.float64)
+	c_values = np.asarray(c_values, dtype=np.float64)
+	counts = _jit_sweep_core(observed, gt, idx, a, b_values, c_values, neighbours_mx, weights, max_iters, warm_start)
+
+	_, _, f1 = _scores_from_counts(counts.reshape(-1, 4))
+
+	return f1.reshape(c_values.size, b_values.size)
+
+
+def denoise_memmap(src, dst, params=(1, 1, 1), shape=None, tile=(512, 512), halo=16, max_iters=100, neighbours=None,
+                   weights=None):
+	"""
+	Tile-by-tile sequential ICM for images that do not fit in memory.
+	src and dst are raw int8 image files (shape is then required for src) or arrays such as
+	np.memmap. Each tile is solved together with a halo of surrounding pixels, of which only
+	the tile itself is written to dst. Halo pixels in tiles that are already done start from
+	their result, which is how neighbouring tiles exchange labels.
+	This is not the same as solving the whole image: the visiting order differs and changes
+	only travel as far as the halo, so near tile borders the result can differ from
+	optimise_local_jit, the more so the smaller the halo.
+	Memory use is bounded by the size of a tile plus its halo.
+	"""
+	a, b, c = params
+
+	if isinstance(src, str):
+		src = np.memmap(src, dtype=np.int8, mode='r', shape=shape)
+	if isinstance(dst, str):
+		dst = np.memmap(dst, dtype=np.int8, mode='w+', shape=src.shape)
+
+	neighbours_mx, weights = _neighbourhood(neighbours, weights)
+
+	rows, cols = src.shape
+	tile_rows, tile_cols = tile
+	for r0 in range(0, rows, tile_rows):
+		for c0 in range(0, cols, tile_cols):
+			r1, c1 = min(r0 + tile_rows, rows), min(c0 + tile_cols, cols)
+			hr0, hc0 = max(r0 - halo, 0), max(c0 - halo, 0)
+			hr1, hc1 = min(r1 + halo, rows), min(c1 + halo, cols)
+
+			observed = np.array(src[hr0:hr1, hc0:hc1], dtype=np.int8)
+			guess = np.copy(observed)
+
+			# tiles are done row by row: everything above and to the left is finished
+			guess[:r0 - hr0] = dst[hr0:r0, hc0:hc1]
+			guess[r0 - hr0:r1 - hr0, :c0 - hc0] = dst[r0:r1, hc0:c0]
+
+			idx = _traversal_indices(guess.shape)
+			_jit_incremental_core(guess, observed, idx, a, b, c, neighbours_mx, weights, max_iters)
+
+			dst[r0:r1, c0:c1] = guess[r0 - hr0:r1 - hr0, c0 - hc0:c1 - hc0]
+
+	if isinstance(dst, np.memmap):
+		dst.flush()
+
+	return dst
+
+
+def optimise_graphcut(observed, params=(1, 1, 1), return_info=False):
+	"""
+	Exact MAP labelling by a minimum s-t cut. For b >= 0 the energy is submodular: a pixel
+	on the source side (+1) cuts its link to the sink, which carries the unary cost of +1
+	over -1, and vice versa; neighbours that disagree cut a link of 2 * b.
+	"""
+	a, b, c = params
+	if b < 0:
+		raise ValueError("Graph cuts need a non-negative coupling b")
+
+	rows, cols = observed.shape
+	unary = 2.0 * (a - c * observed.astype(np.float64)).ravel()
+	cap_s = np.maximum(-unary, 0)
+	cap_t = np.maximum(unary, 0)
+	cap = np.full((rows * cols, 4), 2.0 * b)
+
+	flow, source_side = _jit_maxflow(cap_s, cap_t, cap, rows, cols)
+	guess = np.where(source_side, 1, -1).astype(np.int8).reshape(rows, cols)
+
+	if return_info:
+		return guess, {'flow': flow}
+	return guess
+
+
+def optimise_local(observed, params=(1, 1, 1), start=(0, 0), order='H', init=None, return_info=False):
 	a, b, c = params
 
 	neighbours_mx = np.array([
@@ -105,8 +737,11 @@ def optimise_local(observed, params=(1, 1, 1), start=(0, 0), order='H'):
 		[0, 1]
 	])
 
+	guess = np.copy(observed) if init is None else np.array(init, dtype=np.int8)
+
 	if order == 'V':
 		observed = observed.T
+		guess = guess.T
 		idx = np.arange(len(observed.flatten()))
 	elif order == 'D':
 		idx = get_diagonal_raveled_indices(observed)
@@ -117,10 +752,12 @@ def optimise_local(observed, params=(1, 1, 1), start=(0, 0), order='H'):
 		np.random.shuffle(idx)
 	start_idx = start[0] + start[1] * observed.shape[1]  # input is in xy. column + row*row length
 	idx = np.roll(idx, start_idx)
-	guess = np.copy(observed)
 
-	intermediate_images = [observed]
+	import tqdm
+
+	tracker = ConvergenceTracker(guess)
 	while True:
+		flipped = []
 		for px in tqdm.tqdm(idx, total=guess.size):
 			img_co = np.unravel_index(px, observed.shape, order='F')
 
@@ -136,72 +773,658 @@ def optimise_local(observed, params=(1, 1, 1), start=(0, 0), order='H'):
 
 			if energy_alt < energy_curr:
 				guess[img_co] *= -1
+				flipped.append(img_co[0] * guess.shape[1] + img_co[1])
 
-		if np.any([np.all(guess == img) for img in intermediate_images]):
+		if tracker.update(flipped):
 			# converged. Stronger condition than simply checking whether the last 2 guesses
 			# were the same because we can imagine situations where there is periodicity
 			# (see e.g. Conway's game of life), though this may be side-stepped somewhat by the sequential nature
 
 			break
 
-		intermediate_images.append(np.copy(guess))
-
 	if order == 'V':
 		guess = guess.T
 
+	if return_info:
+		return guess, {'iterations': tracker.sweeps, 'cycle_length': tracker.cycle_length}
 	return guess
 
 
-def optimise_global(observed, params=(1, 1, 1)):
+def _neighbour_sum(img, out):
+	# sum of the 4 neighbours of every pixel, written into out without temporaries
+	out[...] = 0
+	np.add(out[:-1], img[1:], out=out[:-1])
+	np.add(out[1:], img[:-1], out=out[1:])
+	np.add(out[:, :-1], img[:, 1:], out=out[:, :-1])
+	np.add(out[:, 1:], img[:, :-1], out=out[:, 1:])
+
+	return out
+
+
+def _local_energy_dtype(a, b, c):
+	# narrowest dtype holding x_i * (a - c * y_i - b * sum(4 neighbours)) for integer params.
+	# Float params keep float64: float32 rounding changes which pixels have a negative delta
+	if all(np.issubdtype(np.asarray(p).dtype, np.integer) for p in (a, b, c)):
+		bound = int(np.max(np.abs(a))) + int(np.max(np.abs(c))) + 4 * abs(int(b))
+		# the local energy ranges over [-bound, bound], so -bound - 1 sizes it for +bound too
+		return np.promote_types(np.min_scalar_type(-bound - 1), np.int8)
+	return np.dtype(np.float64)
+
+
+def optimise_global(observed, params=(1, 1, 1), update='all', fraction=0.5, init=None, max_iters=1000,
+                    return_info=False):
+	"""
+	Parallel ICM: every iteration flips, all at once, pixels whose flip lowers their local energy.
+	Flipping all of them (update='all') tends to oscillate; the other modes only flip a subset:
+	'checkerboard': one colour after the other, which is equivalent to sequential sweeps
+	'random': every candidate with probability fraction
+	'topk': the fraction of candidates with the largest energy gain, 0 < fraction <= 1
+	All work happens in buffers allocated up front, so an iteration only allocates in
+	proportion to the number of flips.
+	init: initial guess, the observed image if None
+	max_iters: bound on the number of iterations, including those in which no pixel was drawn
+	"""
 	a, b, c = params
 
-	guess = np.copy(observed)
-	intermediate_images = [observed]
+	if update not in ('all', 'checkerboard', 'random', 'topk'):
+		raise ValueError(f"Unknown update mode {update}")
+	if update in ('random', 'topk') and not 0 < fraction <= 1:
+		raise ValueError(f"fraction must be in (0, 1], got {fraction}")
+
+	if update == 'checkerboard':
+		red = np.add.outer(np.arange(observed.shape[0]), np.arange(observed.shape[1])) % 2 == 0
+		phases = [red, ~red]
+	else:
+		phases = [None]
+
+	if update == 'random':
+		# a Generator can draw into a buffer; seeding it from np.random keeps np.random.seed working
+		rng = np.random.default_rng(np.random.randint(2 ** 32))
+		draws = np.empty(observed.shape)
+		drawn = np.empty(observed.shape, dtype=bool)
+
+	guess = np.copy(observed) if init is None else np.array(init, dtype=np.int8)
+	dtype = _local_energy_dtype(a, b, c)
+	# a - c * y, built in place: |a| + |c| fits in dtype
+	unary = observed.astype(dtype)
+	unary *= -c
+	unary += a
+	minus_b = dtype.type(-b)
+	neigh_sum = np.empty(observed.shape, dtype=np.int8)
+	energy_curr = np.empty(observed.shape, dtype=dtype)
+	flips = np.empty(observed.shape, dtype=bool)
+	flipped = np.empty(observed.shape, dtype=bool)
+	flipped_vals = np.empty(observed.shape, dtype=np.int8) if return_info else None
+
+	tracker = ConvergenceTracker(guess)
+	# the energy trace is only kept for return_info: energy() needs full-size temporaries
+	trace = [energy(guess, observed, params)] if return_info else None
+	flip_counts = []
 	i = 0
-	while True:
+	while i < max_iters:
 		i += 1
 		#print(f"{i} parallel iteration{"" if i == 1 else "s"}")
-		energy_curr = guess * (a - c * observed)
-		energy_curr[:-1] += - b * guess[:-1] * guess[1:]
-		energy_curr[1:] += -b * guess[1:] * guess[:-1]
-		energy_curr[:, :-1] += -b * guess[:, :-1] * guess[:, 1:]
-		energy_curr[:, 1:] += -b * guess[:, 1:] * guess[:, :-1]
-
-		# simply -energy_curr
-		energy_alt = -guess * (a - c * observed)
-		energy_alt[:-1] += b * guess[:-1] * guess[1:]
-		energy_alt[1:] += b * guess[1:] * guess[:-1]
-		energy_alt[:, :-1] += b * guess[:, :-1] * guess[:, 1:]
-		energy_alt[:, 1:] += b * guess[:, 1:] * guess[:, :-1]
-
-		# flip where appropriate
-		guess[np.where(energy_alt < energy_curr)] *= -1
-
-		if np.any([np.all(guess == img) for img in intermediate_images]):
+		flipped[...] = False
+		candidates_left = False
+		delta = 0.0
+		for phase in phases:
+			# local energy x_i * (a - c * y_i - b * sum(neighbours)); flipping negates it
+			_neighbour_sum(guess, neigh_sum)
+			np.multiply(neigh_sum, minus_b, out=energy_curr)
+			np.add(energy_curr, unary, out=energy_curr)
+			np.multiply(energy_curr, guess, out=energy_curr)
+
+			# flip where appropriate: energy_alt = -energy_curr < energy_curr
+			np.greater(energy_curr, 0, out=flips)
+			if phase is not None:
+				np.logical_and(flips, phase, out=flips)
+			candidates_left |= flips.any()
+
+			if update == 'random':
+				rng.random(out=draws)
+				np.less(draws, fraction, out=drawn)
+				np.logical_and(flips, drawn, out=flips)
+			elif update == 'topk':
+				gain = energy_curr[flips]
+				k = int(np.ceil(fraction * gain.size))
+				keep = np.zeros(gain.size, dtype=bool)
+				keep[np.argpartition(-gain, k - 1)[:k]] = k > 0
+				flips[flips] = keep
+
+			if return_info:
+				delta -= 2 * np.sum(energy_curr, where=flips, dtype=np.float64)
+				if phase is None:
+					# The flip deltas assume all neighbours stay put. A pair of neighbours flipping
+					# together keeps its product, but both deltas counted the change: 2 * b * x_i * x_j
+					np.multiply(guess, flips, out=flipped_vals)
+					_neighbour_sum(flipped_vals, neigh_sum)
+					np.multiply(neigh_sum, flipped_vals, out=neigh_sum)
+					delta -= 2 * b * np.sum(neigh_sum, dtype=np.int64)
+
+			np.negative(guess, out=guess, where=flips)
+			np.logical_or(flipped, flips, out=flipped)
+
+		if candidates_left and not flipped.any():
+			# the random draw left everything in place, which is not convergence
+			continue
+
+		if return_info:
+			trace.append(trace[-1] + delta)
+			flip_counts.append(np.count_nonzero(flipped))
+
+		if tracker.update(np.flatnonzero(flipped)):
 			# converged. Stronger condition than simply checking whether the last 2 guesses
 			# were the same because we can imagine situations where there is periodicity
 			# (see e.g. Conway's game of life), though this may be side-stepped somewhat by the sequential nature
 
 			break
 
-		intermediate_images.append(np.copy(guess))
+	if return_info:
+		info = {
+			'iterations': tracker.sweeps,
+			'cycle_length': tracker.cycle_length,
+			'energy': np.array(trace),
+			'flips': np.array(flip_counts)
+		}
+		return guess, info
 	return guess
 
 
-def error(original, denoised):
-	pos_gt = set(list(np.where(original.ravel() == 1)[0]))
-	neg_gt = set(list(np.where(original.ravel() == -1)[0]))
-	pos_opt = set(list(np.where(denoised.ravel() == 1)[0]))
-	neg_opt = set(list(np.where(denoised.ravel() == -1)[0]))
+def optimise_path(observed, param_path, optimiser=optimise_local_jit, init=None, **kwargs):
+	"""
+	Continuation: solves for every params tuple along param_path, each solve starting from
+	the result of the previous one. Neighbouring settings converge to nearly the same
+	labelling, so all but the first solve only need a few sweeps.
+	kwargs are passed on to optimiser. Returns the list of results.
+	"""
+	results = []
+	guess = init
+	for params in param_path:
+		guess = optimiser(observed, params, init=guess, **kwargs)
+		results.append(guess)
+
+	return results
+
+
+def _gibbs_setup(observed, params, init, seed, neighbours, weights):
+	neighbours_mx, weights = _neighbourhood(neighbours, weights)
+	if np.any(neighbours_mx.sum(axis=1) % 2 == 0):
+		raise ValueError("Checkerboard updates need a neighbourhood that only couples opposite colours")
+
+	guess = _initial_guess(observed, init)
+	if seed is None:
+		seed = np.random.randint(2 ** 63, dtype=np.uint64)
+
+	return guess, np.uint64(seed), neighbours_mx, weights
+
+
+def sample_gibbs(observed, params=(1, 1, 1), n_samples=100, burn_in=20, temperature=1.0, init=None, seed=None,
+                 neighbours=None, weights=None, return_info=False):
+	"""
+	Estimates the marginals P(x_i = +1) of the posterior exp(-energy / temperature) with a
+	parallel checkerboard Gibbs sampler, averaging n_samples sweeps after burn_in sweeps.
+	Samples are not stored. The same seed gives the same result regardless of thread count.
+	Returns the marginals; return_info adds the last sample and the energy after every sweep.
+	"""
+	if n_samples <= 0:
+		raise ValueError(f"n_samples must be positive, got {n_samples}")
+	if burn_in < 0:
+		raise ValueError(f"burn_in must be non-negative, got {burn_in}")
+
+	a, b, c = params
+	guess, seed, neighbours_mx, weights = _gibbs_setup(observed, params, init, seed, neighbours, weights)
+	initial_energy = energy(guess, observed, params, neighbours_mx, weights) if return_info else None
+
+	temperatures = np.full(burn_in + n_samples, temperature, dtype=np.float64)
+	sample, counts, change = _jit_gibbs_core(guess, observed, a, b, c, neighbours_mx, weights, temperatures,
+	                                         burn_in, seed)
+	marginals = counts / n_samples
+
+	if return_info:
+		return marginals, {'sample': sample, 'energy': initial_energy + change}
+	return marginals
+
+
+def _temperature_schedule(schedule, t_start, t_end, n_sweeps):
+	if schedule == 'geometric':
+		return np.geomspace(t_start, t_end, n_sweeps)
+	if schedule == 'linear':
+		return np.linspace(t_start, t_end, n_sweeps)
+	if isinstance(schedule, str):
+		raise ValueError(f"Unknown schedule {schedule}")
+	return np.asarray(schedule, dtype=np.float64)
+
+
+def anneal(observed, params=(1, 1, 1), n_sweeps=100, t_start=4.0, t_end=0.05, schedule='geometric', init=None,
+           seed=None, max_iters=100, neighbours=None, weights=None, return_info=False):
+	"""
+	Simulated annealing: Gibbs sweeps while the temperature is lowered from t_start to t_end,
+	followed by greedy checkerboard sweeps down to a local minimum.
+	schedule: 'geometric', 'linear' or an explicit array of temperatures, one per sweep
+	Unlike the ICM optimisers this can leave the local minimum nearest to init.
+	"""
+	a, b, c = params
+	guess, seed, neighbours_mx, weights = _gibbs_setup(observed, params, init, seed, neighbours, weights)
+	initial_energy = energy(guess, observed, params, neighbours_mx, weights) if return_info else None
+
+	temperatures = _temperature_schedule(schedule, t_start, t_end, n_sweeps)
+	guess, _, anneal_change = _jit_gibbs_core(guess, observed, a, b, c, neighbours_mx, weights, temperatures,
+	                                          temperatures.size, seed)
+	result, sweeps, cycle_length, change = _jit_checkerboard_core(guess, observed, a, b, c, neighbours_mx, weights,
+	                                                              max_iters)
+
+	if return_info:
+		trace = initial_energy + np.concatenate((anneal_change, anneal_change[-1] + change[1:]))
+		return result, {'iterations': sweeps, 'temperatures': temperatures, 'energy': trace}
+	return result
+
+
+def warmup():
+	"""
+	Compiles, or loads from the on-disk cache, the kernels behind the common calls using a
+	tiny image, so the first real call does not pay for it. Optional: kernels also compile
+	on first use.
+	"""
+	tiny = np.ones((4, 4), dtype=np.int8)
+	for params in ((1, 1, 1), (1.0, 1.0, 1.0)):
+		optimise_local_jit(tiny, params)
+		optimise_local_jit(tiny, params, incremental=True)
+		optimise_local_jit(tiny, params, order='checkerboard')
+	prec_recall_f1(tiny, tiny)
+
+
+def energy(x, y, params=(1, 1, 1), neighbours=None, weights=None):
+	"""
+	Total energy of labelling x given observation y:
+	sum_i x_i * (a - c * y_i) - b * sum_<i,j> w_ij * x_i * x_j, with each neighbour pair counted once
+	"""
+	a, b, c = params
+	neighbours_mx, weights = _neighbourhood(neighbours, weights)
+	rows, cols = x.shape
+
+	unary = np.sum(x * (a - c * y.astype(np.float64)))
+	pairwise = 0.0
+	for (dr, dc), w in zip(neighbours_mx, weights):
+		here, there = _offset_slices(x.shape, dr, dc)
+		pairwise += w * np.sum(x[here] * x[there], dtype=np.int64)
+
+	# every pair was visited from both ends
+	return unary - b * pairwise / 2
+
+
+def _offset_slices(shape, dr, dc):
+	# slices of the pixels that have a neighbour at offset (dr, dc), and of those neighbours
+	rows, cols = shape
+	here = np.s_[max(-dr, 0):rows - max(dr, 0), max(-dc, 0):cols - max(dc, 0)]
+	there = np.s_[max(dr, 0):rows - max(-dr, 0), max(dc, 0):cols - max(-dc, 0)]
+
+	return here, there
+
+
+def _label_costs(a, n_labels):
+	# per-label prior of the Potts model; a scalar is the same constant for every label
+	return np.broadcast_to(np.asarray(a, dtype=np.float64), (n_labels,)).copy()
+
+
+def potts_energy(x, y, n_labels, params=(0, 1, 1), neighbours=None, weights=None):
+	"""
+	Total energy of label map x given observed labels y under the Potts model:
+	sum_i a[x_i] + c * [x_i != y_i] + b * sum_<i,j> w_ij * [x_i != x_j], each pair counted once
+	"""
+	a, b, c = params
+	a = _label_costs(a, n_labels)
+	neighbours_mx, weights = _neighbourhood(neighbours, weights)
+
+	unary = np.sum(a[x]) + np.sum(c * (x != y))
+	pairwise = 0.0
+	for (dr, dc), w in zip(neighbours_mx, weights):
+		here, there = _offset_slices(x.shape, dr, dc)
+		pairwise += w * np.count_nonzero(x[here] != x[there])
+
+	return unary + b * pairwise / 2
+
+
+@njit(cache=True)
+def _jit_potts_core(guess, observed, idx, a, b, c, neighbours_mx, weights, max_iters=100):
+	"""
+	Sequential ICM for the Potts model. A visited pixel moves to the label of lowest local
+	energy a[l] + c * [l != y] + b * sum(weight * [l != neighbour]), all labels being scored
+	in one pass over the neighbours, if that is strictly lower than for its current label.
+	"""
+	rows, cols = observed.shape
+	n_labels = a.size
+	agree = np.empty(n_labels)  # weight of the neighbours having each label
+
+	hashes = np.zeros(max_iters + 1, dtype=np.uint64)
+	hashes[0] = label_hash(guess, n_labels)
+	h = hashes[0]
+
+	change = np.zeros(max_iters + 1)
+	e = 0.0
+
+	sweeps, cycle_length = 0, 0
+	while sweeps < max_iters and cycle_length == 0:
+		sweeps += 1
+		for px in idx:
+			r = px % rows
+			c_idx = px // rows
+
+			agree[:] = 0.0
+			total = 0.0
+			for i in range(neighbours_mx.shape[0]):
+				nr, nc = r + neighbours_mx[i, 0], c_idx + neighbours_mx[i, 1]
+				if 0 <= nr < rows and 0 <= nc < cols:
+					agree[guess[nr, nc]] += weights[i]
+					total += weights[i]
+
+			y = observed[r, c_idx]
+			c_px = _at(c, r, c_idx)
+			curr = guess[r, c_idx]
+			curr_cost = a[curr] + c_px * (curr != y) + b * (total - agree[curr])
+			best, best_cost = curr, curr_cost
+			for label in range(n_labels):
+				cost = a[label] + c_px * (label != y) + b * (total - agree[label])
+				if cost < best_cost:
+					best, best_cost = label, cost
+
+			if best != curr:
+				guess[r, c_idx] = best
+				px_key = np.uint64(r * cols + c_idx) * np.uint64(n_labels)
+				h ^= _pixel_key(px_key + np.uint64(curr)) ^ _pixel_key(px_key + np.uint64(best))
+				e += best_cost - curr_cost
+
+		hashes[sweeps] = h
+		change[sweeps] = e
+		cycle_length = _cycle_length(hashes, sweeps)
+
+	return guess, sweeps, cycle_length, change[:sweeps + 1]
+
+
+def _potts_labels(observed, init, n_labels):
+	# uint8 observation and initial guess; the kernels index per-label arrays with them
+	observed = np.asarray(observed, dtype=np.uint8)
+	guess = np.copy(observed) if init is None else np.array(init, dtype=np.uint8)
+	if guess.shape != observed.shape:
+		raise ValueError(f"init has shape {guess.shape}, expected {observed.shape}")
+	for name, labels in (('Observed', observed), ('Initial', guess)):
+		if labels.size and labels.max() >= n_labels:
+			raise ValueError(f"{name} labels must be below n_labels={n_labels}")
+
+	return observed, guess
+
+
+def optimise_potts_jit(observed, n_labels, params=(0, 1, 1), start=(0, 0), order='H', max_iters=100, init=None,
+                       neighbours=None, weights=None, return_info=False):
+	"""
+	Multi-label denoising/segmentation of a uint8 label map under the Potts model (see
+	potts_energy). params: (a, b, c) with a a scalar or one prior per label and c a scalar or
+	per-pixel array. The remaining arguments are as for optimise_local_jit.
+	"""
+	a, b, c = params
+	a = _label_costs(a, n_labels)
+
+	observed, guess = _potts_labels(observed, init, n_labels)
+	if order == 'checkerboard':
+		raise ValueError("The Potts kernel needs a sequential traversal order")
+
+	neighbours_mx, weights = _neighbourhood(neighbours, weights)
+
+	initial_energy = potts_energy(guess, observed, n_labels, params, neighbours_mx, weights) if return_info else None
+
+	idx = _traversal_indices(observed.shape, order, start)
+	result, sweeps, cycle_length, change = _jit_potts_core(guess, observed, idx, a, b, c, neighbours_mx, weights,
+	                                                       max_iters)
+
+	if return_info:
+		trace = initial_energy + change
+		return result, {'iterations': sweeps, 'cycle_length': cycle_length, 'energy': trace}
+	return result
+
+
+def optimise_potts_global(observed, n_labels, params=(0, 1, 1), update='all', init=None, neighbours=None,
+                          weights=None, max_iters=1000, return_info=False):
+	"""
+	Synchronous Potts ICM: every iteration moves all pixels whose local energy can be lowered
+	to their best label at once, scoring one label at a time over the whole image so memory
+	does not grow with the number of labels. update='checkerboard' moves one colour after the
+	other, which avoids the oscillations of update='all'.
+	max_iters: bound on the number of iterations; cycle_length stays 0 if it is reached first
+	"""
+	a, b, c = params
+	a = _label_costs(a, n_labels)
+
+	observed, guess = _potts_labels(observed, init, n_labels)
+	if update not in ('all', 'checkerboard'):
+		raise ValueError(f"Unknown update mode {update}")
+
+	neighbours_mx, weights = _neighbourhood(neighbours, weights)
+
+	if update == 'checkerboard':
+		if np.any(neighbours_mx.sum(axis=1) % 2 == 0):
+			raise ValueError("Checkerboard updates need a neighbourhood that only couples opposite colours")
+		red = np.add.outer(np.arange(observed.shape[0]), np.arange(observed.shape[1])) % 2 == 0
+		phases = [red, ~red]
+	else:
+		phases = [None]
+
+	# total neighbour weight per pixel, lower at the image border
+	total = np.zeros(observed.shape)
+	for (dr, dc), w in zip(neighbours_mx, weights):
+		here, _ = _offset_slices(observed.shape, dr, dc)
+		total[here] += w
+
+	is_label = np.empty(observed.shape, dtype=bool)
+	agree = np.empty(observed.shape)
+	cost = np.empty(observed.shape)
+	curr_cost = np.empty(observed.shape)
+	best_cost = np.empty(observed.shape)
+	best_label = np.empty(observed.shape, dtype=np.uint8)
+
+	tracker = ConvergenceTracker(guess, n_labels)
+	move_counts = []
+	while tracker.sweeps < max_iters:
+		keys = []
+		moved = 0
+		for phase in phases:
+			best_cost[...] = np.inf
+			for label in range(n_labels):
+				np.equal(guess, label, out=is_label)
+				agree[...] = 0
+				for (dr, dc), w in zip(neighbours_mx, weights):
+					here, there = _offset_slices(observed.shape, dr, dc)
+					agree[here] += w * is_label[there]
+
+				# a[l] + c * [l != y] + b * (total - agree)
+				np.not_equal(observed, label, out=cost)
+				cost *= c
+				cost += a[label] + b * (total - agree)
+
+				np.copyto(curr_cost, cost, where=is_label)
+				better = cost < best_cost
+				np.copyto(best_cost, cost, where=better)
+				best_label[better] = label
+
+			moves = best_cost < curr_cost
+			if phase is not None:
+				moves &= phase
+
+			px = np.flatnonzero(moves).astype(np.uint64) * np.uint64(n_labels)
+			keys.extend([px + guess[moves], px + best_label[moves]])
+			guess[moves] = best_label[moves]
+			moved += px.size
 
-	tp = len(pos_gt.intersection(pos_opt))
-	tn = len(neg_gt.intersection(neg_opt))
-	fp = len(pos_opt.intersection(neg_gt))
-	fn = len(neg_opt.intersection(pos_gt))
+		move_counts.append(moved)
+		if tracker.update(np.concatenate(keys)):
+			break
+
+	if return_info:
+		info = {'iterations': tracker.sweeps, 'cycle_length': tracker.cycle_length, 'flips': np.array(move_counts)}
+		return guess, info
+	return guess
+
+
+@njit(cache=True)
+def _jit_maxflow(cap_s, cap_t, cap, rows, cols):
+	"""
+	Dinic's max-flow on a 4-connected grid with terminal links. Residual capacities are
+	updated in place: cap_s[i] from the source to pixel i, cap_t[i] from pixel i to the sink
+	and cap[i, k] from pixel i to its neighbour in direction k (up, down, left, right), whose
+	reverse is direction k ^ 1. Pixels are raveled in C order.
+	Returns the flow and a mask of the pixels on the source side of the minimum cut.
+	"""
+	n = rows * cols
+	d_row = np.array([-1, 1, 0, 0])
+	d_col = np.array([0, 0, -1, 1])
+	eps = 1e-9
+
+	level = np.empty(n, dtype=np.int64)
+	queue = np.empty(n, dtype=np.int64)
+	arc = np.empty(n, dtype=np.int64)  # current arc per pixel, 4 being the sink
+	stack = np.empty(n, dtype=np.int64)
+
+	flow = 0.0
+	while True:
+		# Layer the residual graph by BFS from the source, up to the first layer touching the sink
+		level[:] = -1
+		head, tail = 0, 0
+		for i in range(n):
+			if cap_s[i] > eps:
+				level[i] = 1
+				queue[tail] = i
+				tail += 1
+
+		sink_level = -1
+		while head < tail:
+			u = queue[head]
+			head += 1
+			if sink_level != -1 and level[u] >= sink_level - 1:
+				continue
+			if cap_t[u] > eps:
+				sink_level = level[u] + 1
+				continue
+
+			r, c = u // cols, u % cols
+			for k in range(4):
+				nr, nc = r + d_row[k], c + d_col[k]
+				if 0 <= nr < rows and 0 <= nc < cols:
+					v = nr * cols + nc
+					if level[v] == -1 and cap[u, k] > eps:
+						level[v] = level[u] + 1
+						queue[tail] = v
+						tail += 1
+
+		if sink_level == -1:
+			# the last BFS marked everything still reachable from the source
+			break
+
+		# Blocking flow: repeated DFS along the layers, removing dead ends
+		arc[:] = 0
+		for src in range(n):
+			if level[src] != 1:
+				continue
+
+			while cap_s[src] > eps:
+				stack[0] = src
+				depth = 0
+				reached = False
+				while depth >= 0:
+					u = stack[depth]
+					k = arc[u]
+					if k == 4:
+						if level[u] == sink_level - 1 and cap_t[u] > eps:
+							reached = True
+							break
+
+						level[u] = -1
+						depth -= 1
+						if depth >= 0:
+							arc[stack[depth]] += 1
+						continue
+
+					nr, nc = u // cols + d_row[k], u % cols + d_col[k]
+					if 0 <= nr < rows and 0 <= nc < cols:
+						v = nr * cols + nc
+						if cap[u, k] > eps and level[v] == level[u] + 1 and level[v] < sink_level:
+							depth += 1
+							stack[depth] = v
+							continue
+					arc[u] += 1
+
+				if not reached:
+					break
+
+				pushed = min(cap_s[src], cap_t[stack[depth]])
+				for d in range(depth):
+					pushed = min(pushed, cap[stack[d], arc[stack[d]]])
+
+				cap_s[src] -= pushed
+				cap_t[stack[depth]] -= pushed
+				for d in range(depth):
+					u, k = stack[d], arc[stack[d]]
+					cap[u, k] -= pushed
+					cap[stack[d + 1], k ^ 1] += pushed
+				flow += pushed
+
+	return flow, level > 0
+
+
+@njit(cache=True)
+def _confusion_counts(gt, img):
+	tp, tn, fp, fn = 0, 0, 0, 0
+	rows, cols = gt.shape
+	for r in range(rows):
+		for c_idx in range(cols):
+			if img[r, c_idx] == 1:
+				if gt[r, c_idx] == 1:
+					tp += 1
+				elif gt[r, c_idx] == -1:
+					fp += 1
+			elif img[r, c_idx] == -1:
+				if gt[r, c_idx] == -1:
+					tn += 1
+				elif gt[r, c_idx] == 1:
+					fn += 1
 
 	return tp, tn, fp, fn
 
 
+@njit(parallel=True, cache=True)
+def _jit_batch_confusion(gt, stack):
+	counts = np.zeros((stack.shape[0], 4), dtype=np.int64)
+	for n in prange(stack.shape[0]):
+		counts[n, 0], counts[n, 1], counts[n, 2], counts[n, 3] = _confusion_counts(gt, stack[n])
+
+	return counts
+
+
+def _scores_from_counts(counts):
+	"""
+	Vectorised precision, recall and F1 from an (N, 4) array of tp, tn, fp, fn
+	"""
+	tp, _, fp, fn = np.asarray(counts, dtype=np.float64).T
+	precision = np.divide(tp, tp + fp, out=np.zeros(tp.shape), where=tp + fp != 0)
+	recall = np.divide(tp, tp + fn, out=np.zeros(tp.shape), where=tp + fn != 0)
+	f1 = np.divide(2 * precision * recall, precision + recall, out=np.zeros(tp.shape), where=precision + recall != 0)
+
+	return precision, recall, f1
+
+
+def error(original, denoised):
+	# raveled, so any shape works; like the raveled index sets this replaced, only positions
+	# present in both arrays count
+	original, denoised = np.ravel(original), np.ravel(denoised)
+	n = min(original.size, denoised.size)
+	return _confusion_counts(original[np.newaxis, :n], denoised[np.newaxis, :n])
+
+
+def error_batch(original, stack):
+	"""
+	Confusion counts of every image of an (N, H, W) stack against one ground truth.
+	Returns an (N, 4) array of tp, tn, fp, fn.
+	"""
+	return _jit_batch_confusion(original, stack)
+
+
 def prec_recall_f1(gt, opt):
 	tp, tn, fp, fn = error(gt, opt)
 	precision = tp / (tp + fp) if tp + fp != 0 else 0
@@ -211,6 +1434,13 @@ def prec_recall_f1(gt, opt):
 	return precision, recall, f1
 
 
+def prec_recall_f1_batch(gt, stack):
+	"""
+	Returns an (N, 3) array with the precision, recall and F1 of every image in the stack
+	"""
+	return np.stack(_scores_from_counts(error_batch(gt, stack)), axis=1)
+
+
 def get_diagonal_raveled_indices(matrix):
 	row_idx, col_idx = np.indices(matrix.shape)
 